@@ -39,7 +39,24 @@ VERSION = "v1.1 (2014-01-04)"
 import sys, os, errno, traceback, time, re, datetime
 
 # File and encryption handling
-import fnmatch, shutil, gnupg
+import fnmatch, shutil, gnupg, hashlib, hmac, json, math, struct, zlib
+
+# Worker threads
+import threading, Queue   # XXX - Change to "queue" for Python 3.0
+
+# S3 destination handling - boto is only needed for s3:// destinations
+import tempfile, cStringIO
+try:
+    import boto, boto.s3.connection, boto.s3.multipart
+except ImportError:
+    boto = None
+
+# Fast chunk boundary search for deduplicated archives - numpy is optional,
+# without it boundaries are found one byte at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Configuration handling
 import ConfigParser   # XXX - Change to "configparser" for Python 3.0
@@ -52,6 +69,51 @@ import signal, logging, logging.handlers, smtplib, email, syslog
 DEFCONFFILE = "/etc/encrarch.conf"
 DEFINSTANCENAME = "encrarch"
 
+# Deduplicated archive settings - Chunks are stored in a hidden folder under
+# destroot so they are shared by all date folders
+CHUNKSTORE = ".encrarch-chunks"
+RECIPESUFFIX = ".recipe.gpg"
+REFSSUFFIX = ".refs"
+DEFCHUNKSIZE = 4194304
+
+# Optional per date folder list of SHA-256 and size for each archived file,
+# and the checkpoint kept in a restore target to allow resuming
+MANIFEST = ".encrarch-manifest"
+RESTORECHECKPOINT = ".encrarch-restore"
+DEFRESTOREWORKERS = 2
+
+# Index of date folder sizes under destroot, kept for retention checks
+SIZEINDEX = ".encrarch-sizes"
+
+# Encrypted size estimates - Blocks of the source compressed to sample its
+# compressibility, margin added to each estimate, and bytes of GnuPG packet
+# overhead per file.  Ratios seen in earlier runs are kept under destroot
+ESTSAMPLES = 8
+ESTBLOCKSIZE = 131072
+ESTMARGIN = 1.01
+GPGOVERHEAD = 1024
+RATIOINDEX = ".encrarch-ratios"
+
+# Memory staging - Default limit on memory used by all files staged at once,
+# and the block size they are read in
+DEFRAMBUDGET = 268435456
+STAGEBLOCKSIZE = 1048576
+
+# S3 multipart upload defaults - 5MB is the smallest part S3 allows
+DEFS3PARTSIZE = 67108864
+MINS3PARTSIZE = 5242880
+DEFS3PARTBUFFER = 2
+DEFS3UPLOADTHREADS = 4
+
+# Gear hash table for content-defined chunking - Derived from MD5 so chunk
+# boundaries stay the same between runs and Python versions
+GEARTABLE = [struct.unpack('>I', hashlib.md5("encrarch-gear-%d" % i).digest()[:4])[0] for i in range(256)]
+
+# Most bytes hashed at a time when searching for chunk boundaries with numpy
+CHUNKSCANBLOCK = 1048576
+if numpy is not None:
+    GEARARRAY = numpy.array(GEARTABLE, dtype=numpy.uint32)
+
 def findSourceFiles (pattern, duppattern, basepath, pathpattern):
     """
     Find files matching pattern under basepath. Return array with filename /
@@ -128,21 +190,112 @@ def getFreeSpace(folder):
     return os.statvfs(folder).f_bfree * os.statvfs(folder).f_frsize
 
 
-def roomForFiles(sourcebase, sources, destfolder):
+def humanSize (s):
     """
-    Check if there is room for the given file set in the given destfolder
-    Sources must be an array of arrays with file/patch pairs as members.
-    Returns two values:
-     * The available space minus the required space. (Negative values are bad!)
-     * The required space by itself
+    Pretty print a size in bytes - From Anonymous post to
+    http://www.5dollarwhitebox.org/drupal/node/84
     """
+    return [(s%1024**i and "%.1f"%(s/1024.0**i) or str(s/1024**i))+x.strip() for i,x in enumerate(' KMGTPEZY') if s<1024**(i+1) or i==8][0]
 
-    # Add up numbers
-    tsize = 0
-    for sourcefile, relpath in sources:
-        tsize += os.stat(os.path.normpath(os.sep.join((sourcebase,relpath,sourcefile)))).st_size
 
-    return (getFreeSpace(destfolder) - tsize, tsize)
+def estimateEncryptedSize(path, size):
+    """
+    Estimate the size of the GnuPG output for file path, size bytes long.
+    GnuPG compresses with zlib before encrypting, so ESTSAMPLES blocks spread
+    through the file (or the whole file, if small) are compressed the same
+    way to find how well it compresses.  Returns bytes - If the file can not
+    be read, it is assumed not to compress (encryptFile reports the problem)
+    """
+    raw = 0
+    packed = 0
+    try:
+        fh = open(path, 'rb')
+        try:
+            if size <= ESTSAMPLES * ESTBLOCKSIZE:
+                offsets = range(0, size, ESTBLOCKSIZE)
+            else:
+                offsets = [(size - ESTBLOCKSIZE) * i // (ESTSAMPLES - 1) for i in range(ESTSAMPLES)]
+            for offset in offsets:
+                fh.seek(offset)
+                data = fh.read(ESTBLOCKSIZE)
+                raw += len(data)
+                packed += len(zlib.compress(data, 6))
+        finally:
+            fh.close()
+    except (IOError, OSError):
+        return size + GPGOVERHEAD
+
+    if not raw:
+        return GPGOVERHEAD
+    return int(math.ceil(size * packed * ESTMARGIN / raw)) + GPGOVERHEAD
+
+
+def ratioKey(sets, filename, relpath):
+    """
+    Return the run history key for a source file of the job with settings
+    sets - The job name, relative path, and the name matched by
+    sourcejobnameregex (or the filename, if not used or not matched)
+    """
+    name = filename
+    if sets['sourcejobnameregex']:
+        m = re.search(sets['sourcejobnameregex'], filename)
+        if (m):
+            name = m.group(1)
+    return ":".join((sets['jobname'], relpath, name))
+
+
+def estimateSources(sets, sources, history):
+    """
+    Estimate the encrypted size of each file in sources for the job with
+    settings sets.  The ratio of encrypted to source size seen for the same
+    key (See ratioKey) in earlier runs is used if history has one, else the
+    file is sampled.  Returns a dictionary of filename / relative path pair
+    to source bytes / estimated bytes pair, and the number of estimates
+    taken from history
+    """
+    estimates = {}
+    known = 0
+    for (filename, relpath) in sources:
+        path = os.path.normpath(os.sep.join((sets['sourcebase'],relpath,filename)))
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            # Gone since it was found - encryptFile will skip it
+            size = 0
+        key = ratioKey(sets, filename, relpath)
+        if key in history:
+            estimates[(filename, relpath)] = (size, int(math.ceil(size * history[key] * ESTMARGIN)))
+            known += 1
+        else:
+            estimates[(filename, relpath)] = (size, estimateEncryptedSize(path, size))
+
+    return (estimates, known)
+
+
+def spaceNeeded(destbase, estimates, dedup, workers):
+    """
+    Return the bytes needed under destbase to archive files with the given
+    estimates (See estimateSources), plus the extra bytes needed while they
+    are written.  A file replacing an earlier copy in destbase only adds the
+    difference, but both copies exist until its .gpg.tmp is renamed into
+    place, so room is kept for the largest copies workers could be replacing
+    at once.  (Deduplicated files count in full - Their estimates only cover
+    the new chunks, refs, and recipe seen in earlier runs)
+    """
+    needed = 0
+    replaced = []
+    for ((filename, relpath), (size, est)) in estimates.items():
+        existing = 0
+        if not dedup:
+            try:
+                existing = os.path.getsize(os.path.join(os.path.normpath(os.sep.join((destbase, relpath))), filename + ".gpg"))
+            except OSError:
+                pass
+        needed += max(0, est - existing)
+        replaced.append(existing)
+
+    replaced.sort(reverse=True)
+    return (needed, sum(replaced[:workers]))
 
 
 def makeDirTree (path):
@@ -157,13 +310,11 @@ def makeDirTree (path):
         else: raise
 
 
-def copySourceToTempSource (source, sourcebase, tempbase):
+def copySourceToTempSource (source, sourcebase, tempbase, throttle=None):
     """
     Take an array of filename / path pairs underneath basepath and copy into
-    temp directory, returning a new array with filename, path pairs, adjusted
-    for the temp path
+    temp directory.  Reads are limited by throttle, if set
     """
-    destfiles = []
     for (filename, relpath) in source:
         destpath = os.path.normpath(os.sep.join((tempbase, relpath)))
 
@@ -171,9 +322,45 @@ def copySourceToTempSource (source, sourcebase, tempbase):
         makeDirTree(destpath)
 
         # Copy the file into temp
-        shutil.copyfile(os.path.normpath(os.sep.join((sourcebase,relpath,filename))),os.path.join(destpath,filename))
+        if throttle:
+            src = ThrottledReader(open(os.path.normpath(os.sep.join((sourcebase,relpath,filename))), 'rb'), throttle)
+            dst = open(os.path.join(destpath,filename), 'wb')
+            try:
+                shutil.copyfileobj(src, dst)
+            finally:
+                src.close()
+                dst.close()
+        else:
+            shutil.copyfile(os.path.normpath(os.sep.join((sourcebase,relpath,filename))),os.path.join(destpath,filename))
+
 
-        destfiles.append([filename, destpath])
+def stageSourceInMemory (path, size, throttle=None):
+    """
+    Read path, size bytes long, into a buffer of exactly that size, so the
+    copy uses no more than the memory claimed for it (See MemoryBudget).
+    Returns a StagedReader over the copy.  Raises IOError if the file is no
+    longer size bytes long once read - It is still being written, and the
+    copy would not match it.  Reads are limited by throttle, if set
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    fh = open(path, 'rb')
+    try:
+        done = 0
+        while done < size:
+            count = fh.readinto(view[done:min(size, done + STAGEBLOCKSIZE)])
+            if not count:
+                break
+            if throttle:
+                throttle.consume(count)
+            done += count
+        now = os.fstat(fh.fileno()).st_size
+    finally:
+        fh.close()
+
+    if done != size or now != size:
+        raise IOError("Source %s changed size while being staged (%d bytes expected, %d read, now %d)" % (path, size, done, now))
+    return StagedReader(buf)
 
 
 def clearTempSource (source, tempbase):
@@ -199,15 +386,12 @@ def getGpgHome ():
     return home
 
 
-def lookupKeyFingerprint (gpgbinary, gpghome, fingerprint):
+def lookupKeyFingerprint (gpg, fingerprint):
     """
-    Check for existence of a recipient key and return their first UID, or an
-    empty string if not found
+    Check for existence of a recipient key in the keyring of gnupg.GPG
+    instance gpg and return their first UID, or an empty string if not found
     """
 
-    # Create our GnuPG instance
-    gpg = gnupg.GPG(gpgbinary=gpgbinary, gnupghome=gpghome)
-
     # Check that the recipient's key exists
     found = ""
     for gpgkey in gpg.list_keys():
@@ -223,74 +407,103 @@ def lookupKeyFingerprint (gpgbinary, gpghome, fingerprint):
     return found
 
 
-def encryptSourcesToDestination (source, tempbase, destbase, gpgbinary, gpghome, recipient, logger):
+def encryptFile (gpg, filename, basepath, tempbase, destbase, recipient, logger, chunkstore=None, manifest=None, throttle=None, staged=None, outcome=None):
     """
-    Take an array of filename, path pairs and run through GnuPGP, encrypting
-    for recipient (a key ID) and outputting to files under the destination path.
-    Takes the following arguments (should switch to named, but just have not)
-    * source - An array of filename/path pairs
+    Encrypt one source file for recipient into the matching path under destbase.
+    Takes the following arguments:
+    * gpg - gnupg.GPG instance to encrypt with
+    * filename, basepath - The source file name and its path relative to tempbase
     * tempbase - If using a temporary store, location of temp copies of files.
-      (Else, set to the same as the source base path_
+      (Else, set to the same as the source base path)
     * destbase - Base path to copy encrypted files into, mirroring the source path
-    * gpgbinary - Name of GnuPG binary
-    * gpghome - Home folder for GnuPG configuration files, keys, etc for user
     * recipient - PGP key to encrypt to
     * logger - logging class instance
-
-    (Yes - This thing cries out for wrapping in a class... later!)
+    * chunkstore - Optional ChunkStore instance - If set, files are saved as
+      deduplicated recipes instead of whole encrypted files
+    * manifest - Optional dictionary - If set, the SHA-256 and size of each
+      archived file is added, keyed by the path relative to destbase
+    * throttle - Optional Throttle instance to limit the read rate
+    * staged - Optional file object over a copy of the source held in memory
+      (See stageSourceInMemory) - Read instead of the file under tempbase
+    * outcome - Optional dictionary - If set, "written" is set to the
+      encrypted bytes written, or "reason" to why the file was skipped.  For
+      deduplicated files, "written" only counts their new chunks, refs, and
+      recipe, and is only set when the file is first written to destbase - A
+      rerun into the same folder finds nearly all chunks already stored, so
+      says little about the next date folder
+    Returns the number of source bytes read, or None if the file was skipped
     """
-    destfiles = []
-
-    # Create our GnuPG instance
-    gpg = gnupg.GPG(gpgbinary=gpgbinary, gnupghome=gpghome)
+    destpath = os.path.normpath(os.sep.join((destbase, basepath)))
 
-    for (filename, basepath) in source:
-        destpath = os.path.normpath(os.sep.join((destbase, basepath)))
-
-        # Create the folder path as needed
-        try:
-            makeDirTree(destpath)
-        except OSError:
-            logger.warning("Could not build destination folders under %s: Skipping %s" % (destpath, filename))
-            continue
-
-        # Open the source file with default system buffering
-        sfile = os.path.normpath(os.sep.join((tempbase,basepath,filename)))
+    # Create the folder path as needed
+    try:
+        makeDirTree(destpath)
+    except OSError:
+        logger.warning("Could not build destination folders under %s: Skipping %s" % (destpath, filename))
+        if outcome is not None:
+            outcome['reason'] = "Could not build destination folders under %s" % destpath
+        return None
+
+    # Open the source file with default system buffering
+    sfile = os.path.normpath(os.sep.join((tempbase,basepath,filename)))
+    if staged is not None:
+        sfileh = staged
+    else:
         try:
             sfileh = open(sfile,'rb', -1)
         except:
             logger.warning("Could not open source %s for reading: Skipping" % sfile)
-            continue
-
-        # Add the standard .gpg suffix, then set the full path and temp
-        # path
+            if outcome is not None:
+                outcome['reason'] = "Could not open source %s for reading" % sfile
+            return None
+
+    # Hash the source as it is read if building a manifest, and count what
+    # is read either way
+    relname = os.path.normpath(os.path.join(basepath, filename)).lstrip(os.sep)
+    if throttle:
+        sfileh = ThrottledReader(sfileh, throttle)
+    sfileh = HashingReader(sfileh, manifest is not None)
+
+    # Add the standard .gpg suffix (or recipe suffix for deduplicated
+    # archives), then set the full path and temp path
+    if chunkstore:
+        filename += RECIPESUFFIX
+    else:
         filename += ".gpg"
-        fullfilename = os.path.join(destpath, filename)
-        fulltempfilename = fullfilename + ".tmp"
+    fullfilename = os.path.join(destpath, filename)
+    fulltempfilename = fullfilename + ".tmp"
+    replacing = os.path.exists(fullfilename)
 
-        # Crypt! (To a temp file) 
-        try:
-            gpg.encrypt_file(sfileh, recipient, output=fulltempfilename, armor=False)
-        except Exception as detail:
-            # This catches and ignores exceptions - XXX - Should be 
-            # updated to only catch what is expected from the GnuPG module
-            logger.warning("Problem while encrypting %s: \"%s\" - Skipping" % (sfile, detail))  
-            
-            # Attempt to unlink the temp file, if it was created
-            try:
-                os.unlink(fulltempfilename)
-            except OSError as exc:
-                # Ignore error for missing temp file - good!
-                if exc.errno == errno.EEXIST:
-                    pass
-                else:
-                    # Pass this up - Something else is happening
-                    raise
+    # Crypt! (To a temp file) 
+    try:
+        if chunkstore:
+            refsfilename = fullfilename[:-len(RECIPESUFFIX)] + REFSSUFFIX
+            (size, newsize, chunks, newchunks, newbytes) = chunkstore.archiveFile(sfileh, fullfilename, refsfilename)
+            logger.debug("Stored %d of %d chunks (%d of %d bytes) for %s" % (newchunks, chunks, newsize, size, sfile))
+        else:
+            result = gpg.encrypt_file(sfileh, recipient, output=fulltempfilename, armor=False)
+            if not result.ok:
+                raise GeneralError("GnuPG failed: %s" % result.status)
+            newbytes = os.path.getsize(fulltempfilename)
+    except Exception as detail:
+        # This catches and ignores exceptions - XXX - Should be 
+        # updated to only catch what is expected from the GnuPG module
+        logger.warning("Problem while encrypting %s: \"%s\" - Skipping" % (sfile, detail))  
+        if outcome is not None:
+            outcome['reason'] = "Problem while encrypting: %s" % detail
+
+        # Attempt to unlink the temp file, if it was created - Anything
+        # other than a missing temp file is passed up
+        removeFile(fulltempfilename)
+
+        # Process the next file
+        return None
+    finally:
+        sfileh.close()
 
-            # Process the next file
-            continue
-        
-        # Move the temp to the final location
+    # Move the temp to the final location - archiveFile moves recipes into
+    # place itself, along with their refs
+    if not chunkstore:
         try:
             os.rename(fulltempfilename, fullfilename)
         except OSError as exc: # Python >2.5
@@ -298,10 +511,845 @@ def encryptSourcesToDestination (source, tempbase, destbase, gpgbinary, gpghome,
                 pass
             else:
                 raise
-        
-        destfiles.append([filename, destpath])
 
-        logger.info("Completed encrypting file %s" % fullfilename)
+    if manifest is not None:
+        manifest[relname] = (sfileh.hexdigest(), sfileh.size)
+    if outcome is not None and not (chunkstore and replacing):
+        outcome['written'] = newbytes
+
+    logger.info("Completed encrypting file %s" % fullfilename)
+    return sfileh.size
+
+
+class Throttle(object):
+    """
+    Read bandwidth limit shared by all workers - Readers report the bytes
+    they read and are held back while the combined rate is over the limit
+    """
+
+    def __init__(self, rate):
+        """
+         rate - Bytes per second allowed across all readers
+        """
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.total = 0
+
+    def consume(self, size):
+        """
+        Account for size bytes read, sleeping as needed to hold the rate
+        """
+        self.lock.acquire()
+        try:
+            self.total += size
+            delay = self.start + float(self.total) / self.rate - time.time()
+
+            # Do not let idle time build up more than a second of credit
+            if delay < -1.0:
+                self.start -= delay + 1.0
+        finally:
+            self.lock.release()
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MemoryBudget(object):
+    """
+    Memory limit shared by all workers for sources staged in memory - Workers
+    claim the size of a file before reading it in, and wait while the claims
+    of the other workers leave too little room
+    """
+
+    def __init__(self, limit):
+        """
+         limit - Bytes allowed for all staged files at once
+        """
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def claim(self, size):
+        """
+        Wait until size bytes fit within the limit and claim them.  A file
+        larger than the limit still gets a turn, once nothing else is staged
+        """
+        self.cond.acquire()
+        try:
+            while self.used and self.used + size > self.limit:
+                self.cond.wait(1)
+            self.used += size
+        finally:
+            self.cond.release()
+
+    def release(self, size):
+        """
+        Return size bytes claimed earlier
+        """
+        self.cond.acquire()
+        try:
+            self.used -= size
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+class ThrottledReader(object):
+    """
+    File wrapper that reports reads to a Throttle
+    """
+
+    def __init__(self, fh, throttle):
+        self.fh = fh
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+    def close(self):
+        self.fh.close()
+
+
+class StagedReader(object):
+    """
+    File object over a source staged in memory (See stageSourceInMemory) -
+    Reads are copied from the buffer, which is dropped on close
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.buf) - self.pos
+        data = memoryview(self.buf)[self.pos:self.pos + size].tobytes()
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.buf = bytearray()
+
+
+class HashingReader(object):
+    """
+    File wrapper that hashes and counts data as it is read - Set hashing
+    to False to only count
+    """
+
+    def __init__(self, fh, hashing=True):
+        self.fh = fh
+        self.hash = hashlib.sha256()
+        self.hashing = hashing
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        if self.hashing:
+            self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self.fh.close()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def fileHash (path):
+    """
+    Return the SHA-256 hex digest and size of a file
+    """
+    fh = HashingReader(open(path, 'rb'))
+    try:
+        while fh.read(1048576):
+            pass
+    finally:
+        fh.close()
+    return (fh.hexdigest(), fh.size)
+
+
+def readManifest (destbase):
+    """
+    Read the manifest in a date folder, returning a dictionary of relative
+    path to (SHA-256, size).  Returns an empty dictionary if there is none
+    """
+    manifest = {}
+    try:
+        fh = open(os.path.join(destbase, MANIFEST), 'r')
+    except IOError:
+        return manifest
+    try:
+        for line in fh:
+            (digest, size, relname) = line.rstrip("\n").split(" ", 2)
+            manifest[relname] = (digest, int(size))
+    finally:
+        fh.close()
+    return manifest
+
+
+def updateManifest (destbase, entries):
+    """
+    Merge entries into the manifest in a date folder.  Files archived again
+    in the same folder replace their old entries
+    """
+    manifest = readManifest(destbase)
+    manifest.update(entries)
+    lines = ["%s %d %s\n" % (manifest[relname][0], manifest[relname][1], relname) for relname in sorted(manifest)]
+    writeFileAtomic(os.path.join(destbase, MANIFEST), "".join(lines))
+
+
+def findChunkBoundary (data, minsize, maxsize, mask):
+    """
+    Return the length of the next content-defined chunk at the start of data.
+    A rolling Gear hash is run from minsize onward and the chunk is cut where
+    the masked high bits of the hash are all zero, or at maxsize
+    """
+    end = min(len(data), maxsize)
+    if end <= minsize:
+        return end
+
+    if numpy is not None:
+        return findChunkBoundaryNumpy(data, minsize, end, mask)
+
+    gear = GEARTABLE
+    h = 0
+    for i in xrange(minsize, end):
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+        if not (h & mask):
+            return i + 1
+
+    return end
+
+
+def findChunkBoundaryNumpy (data, minsize, end, mask):
+    """
+    findChunkBoundary using numpy, for data between minsize and end.  Each
+    shift of the 32 bit Gear hash drops the oldest bit, so the hash at a byte
+    is the sum of the table values of the (up to) 32 bytes ending there, each
+    shifted by its distance back.  That sum is built for a whole block at
+    once by doubling the window five times.  The hash starts from minsize, as
+    in the byte at a time loop, so boundaries are the same
+    """
+    # Blocks start near the expected chunk size (four times minsize) and
+    # grow, so little is hashed past the boundary
+    block = min(max(minsize, 4096), CHUNKSCANBLOCK)
+    pos = minsize
+    while pos < end:
+        stop = min(pos + block, end)
+        block = min(block * 2, CHUNKSCANBLOCK)
+
+        # Include the 31 bytes before the block that still reach its hashes
+        start = max(minsize, pos - 31)
+        h = GEARARRAY[numpy.frombuffer(data, dtype=numpy.uint8, count=stop - start, offset=start)]
+        shifted = numpy.empty_like(h)
+        for step in (1, 2, 4, 8, 16):
+            n = len(h) - step
+            if n <= 0:
+                break
+            numpy.left_shift(h[:n], numpy.uint32(step), out=shifted[:n])
+            numpy.add(h[step:], shifted[:n], out=h[step:])
+
+        hits = numpy.flatnonzero((h[pos - start:] & mask) == 0)
+        if len(hits):
+            return pos + int(hits[0]) + 1
+        pos = stop
+
+    return end
+
+
+def writeFileAtomic (path, data):
+    """
+    Write data to path using a temporary file and rename, so readers never
+    see a partial file
+    """
+    temppath = path + ".tmp"
+    fh = open(temppath, 'wb')
+    try:
+        fh.write(data)
+    finally:
+        fh.close()
+    os.rename(temppath, path)
+
+
+class ChunkStore(object):
+    """
+    Deduplicated chunk store - Files are split with content-defined chunking
+    and each chunk is encrypted and saved under an HMAC-SHA256 of its
+    plaintext, keyed by the dedupkey setting so the IDs cannot be used to
+    confirm known content without the key.  Chunks already in the store are
+    not encrypted or written again.  Each archived file becomes an encrypted
+    recipe listing its chunks, plus a plain text .refs file listing the
+    chunk IDs so garbage collection can run without the secret key.  Chunks
+    are kept in a separate folder for each recipient key, so a chunk
+    encrypted for one key is never reused in an archive for another
+    """
+
+    def __init__(self, storeroot, gpg, recipient, avgsize=DEFCHUNKSIZE, key=''):
+        """
+         storeroot - Folder to hold the chunks (Usually destroot/CHUNKSTORE)
+         gpg - gnupg.GPG instance to encrypt/decrypt with (None if only
+           collecting garbage)
+         recipient - PGP key to encrypt to
+         avgsize - Approximate average chunk size in bytes
+         key - Secret used to derive chunk IDs (Required to store or verify)
+        """
+        self.storeroot = storeroot
+        self.storepath = os.path.join(storeroot, recipient)
+        self.gpg = gpg
+        self.recipient = recipient
+        self.key = key
+
+        # Chunks fall between a quarter and four times the average size.
+        # The boundary mask covers the high bits of the 32 bit Gear hash,
+        # which depend on the most bytes in the window
+        self.minsize = avgsize / 4
+        self.maxsize = avgsize * 4
+        bits = int(math.log(avgsize, 2))
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+
+        # Set of chunk IDs already saved - Loaded on first use.  The lock
+        # covers it when several workers share the store
+        self.known = None
+        self.lock = threading.Lock()
+
+    def chunkPath(self, chunkid, recipient=None):
+        """
+        Return the full path to a chunk file, encrypted for recipient if set or
+        the store's recipient if not
+        """
+        return os.path.join(self.storeroot, recipient or self.recipient, chunkid[:2], chunkid + ".gpg")
+
+    def knownChunks(self):
+        """
+        Return the set of chunk IDs in the store, scanning it on first call
+        """
+        self.lock.acquire()
+        try:
+            if self.known is None:
+                known = set()
+                for base, dirs, files in os.walk(self.storepath):
+                    for filename in fnmatch.filter(files, "*.gpg"):
+                        known.add(filename[:-4])
+                self.known = known
+        finally:
+            self.lock.release()
+        return self.known
+
+    def chunks(self, fh):
+        """
+        Generator returning the content-defined chunks read from file handle fh
+        """
+        buf = bytearray()
+        eof = False
+        while True:
+            # Keep at least one maximum sized chunk in the buffer
+            while not eof and len(buf) < self.maxsize:
+                data = fh.read(self.maxsize)
+                if not data:
+                    eof = True
+                buf.extend(data)
+
+            if not buf:
+                return
+
+            cut = findChunkBoundary(buf, self.minsize, self.maxsize, self.mask)
+            yield str(buf[:cut])
+            del buf[:cut]
+
+    def chunkId(self, chunk):
+        """
+        Return the ID of a chunk - The HMAC-SHA256 of its plaintext
+        """
+        if not self.key:
+            raise GeneralError("You must set 'dedupkey' to store or verify deduplicated chunks")
+        return hmac.new(self.key, chunk, hashlib.sha256).hexdigest()
+
+    def storeChunk(self, chunk):
+        """
+        Encrypt and save a chunk if it is not already in the store.  Returns
+        the chunk ID and the encrypted bytes written (0 if already stored)
+        """
+        chunkid = self.chunkId(chunk)
+        if chunkid in self.knownChunks():
+            return (chunkid, 0)
+
+        chunkfile = self.chunkPath(chunkid)
+        makeDirTree(os.path.dirname(chunkfile))
+
+        # Workers may store the same new chunk at once, so each uses its own
+        # temp file - The last rename wins with identical content
+        tempfile = "%s.tmp%d" % (chunkfile, threading.current_thread().ident)
+        result = self.gpg.encrypt(chunk, self.recipient, armor=False, output=tempfile)
+        if not result.ok:
+            removeFile(tempfile)
+            raise GeneralError("Could not encrypt chunk %s: %s" % (chunkid, result.status))
+        written = os.path.getsize(tempfile)
+        os.rename(tempfile, chunkfile)
+
+        self.known.add(chunkid)
+        return (chunkid, written)
+
+    def archiveFile(self, fh, recipefile, refsfile):
+        """
+        Store all chunks read from fh, then write the chunk ID list to refsfile
+        and the encrypted recipe to recipefile.  The refs file is written
+        first so garbage collection never removes chunks of a saved recipe -
+        When replacing a recipe, it lists the chunks of both until the new
+        recipe is in place, and is put back if the new recipe can not be
+        saved.  Returns the file size, newly stored bytes, chunk count, newly
+        stored chunk count, and encrypted bytes written (new chunks, refs, and
+        recipe)
+        """
+        recipe = []
+        size = newsize = newchunks = written = 0
+        for chunk in self.chunks(fh):
+            (chunkid, stored) = self.storeChunk(chunk)
+            recipe.append([chunkid, len(chunk)])
+            size += len(chunk)
+            if stored:
+                newsize += len(chunk)
+                newchunks += 1
+                written += stored
+
+        refs = set([chunkid for chunkid, length in recipe])
+        oldrefs = self.readRefs(refsfile)
+        if oldrefs is not None:
+            self.writeRefs(refsfile, refs | oldrefs)
+        else:
+            self.writeRefs(refsfile, refs)
+
+        data = json.dumps({'version': 1, 'recipient': self.recipient, 'size': size, 'chunks': recipe})
+        temprecipefile = recipefile + ".tmp"
+        try:
+            result = self.gpg.encrypt(data, self.recipient, armor=False, output=temprecipefile)
+            if not result.ok:
+                raise GeneralError("Could not encrypt recipe %s: %s" % (recipefile, result.status))
+            os.rename(temprecipefile, recipefile)
+        except:
+            removeFile(temprecipefile)
+            if oldrefs is not None:
+                self.writeRefs(refsfile, oldrefs)
+            else:
+                removeFile(refsfile)
+            raise
+
+        if oldrefs is not None:
+            self.writeRefs(refsfile, refs)
+        written += os.path.getsize(refsfile) + os.path.getsize(recipefile)
+
+        return (size, newsize, len(recipe), newchunks, written)
+
+    def readRefs(self, refsfile):
+        """
+        Return the set of chunk IDs listed in refsfile, or None if there is
+        no such file
+        """
+        try:
+            fh = open(refsfile, 'r')
+        except IOError:
+            return None
+        try:
+            return set([line.strip() for line in fh if line.strip()])
+        finally:
+            fh.close()
+
+    def writeRefs(self, refsfile, refs):
+        """
+        Save the set of chunk IDs refs to refsfile
+        """
+        writeFileAtomic(refsfile, "".join(["%s\n" % chunkid for chunkid in sorted(refs)]))
+
+    def readRecipe(self, recipefile, passphrase=None):
+        """
+        Decrypt and return a recipe as a dictionary
+        """
+        fh = open(recipefile, 'rb')
+        try:
+            result = self.gpg.decrypt_file(fh, passphrase=passphrase)
+        finally:
+            fh.close()
+        if not result.ok:
+            raise GeneralError("Could not decrypt recipe %s: %s" % (recipefile, result.status))
+
+        try:
+            return json.loads(result.data)
+        except ValueError:
+            raise GeneralError("Recipe %s is corrupt" % recipefile)
+
+    def rebuild(self, recipefile, outputfile, passphrase=None):
+        """
+        Rebuild the original file from a recipe, verifying each chunk against
+        its ID.  Writes to a temp file and renames into place when complete.
+        Returns the rebuilt size
+        """
+        recipe = self.readRecipe(recipefile, passphrase)
+
+        tempfile = outputfile + ".tmp"
+        out = open(tempfile, 'wb')
+        try:
+            for chunkid, length in recipe['chunks']:
+                chunkfile = self.chunkPath(chunkid, recipe['recipient'])
+                try:
+                    fh = open(chunkfile, 'rb')
+                except IOError:
+                    raise GeneralError("Missing chunk %s needed by %s" % (chunkid, recipefile))
+                try:
+                    result = self.gpg.decrypt_file(fh, passphrase=passphrase)
+                finally:
+                    fh.close()
+
+                if not result.ok:
+                    raise GeneralError("Could not decrypt chunk %s: %s" % (chunkid, result.status))
+                if len(result.data) != length or self.chunkId(result.data) != chunkid:
+                    raise GeneralError("Chunk %s failed verification" % chunkid)
+
+                out.write(result.data)
+        except:
+            out.close()
+            os.unlink(tempfile)
+            raise
+        out.close()
+
+        if os.path.getsize(tempfile) != recipe['size']:
+            os.unlink(tempfile)
+            raise GeneralError("Rebuilt size of %s does not match recipe" % outputfile)
+
+        os.rename(tempfile, outputfile)
+        return recipe['size']
+
+    def collectGarbage(self, destroot):
+        """
+        Remove chunks not listed in any .refs file under destroot, along with
+        partial chunks left by interrupted runs.  Returns the number of chunks
+        and bytes removed
+        """
+        referenced = set()
+        for base, dirs, files in os.walk(destroot):
+            # Do not descend into the store itself
+            if base == destroot and os.path.basename(self.storeroot) in dirs:
+                dirs.remove(os.path.basename(self.storeroot))
+            for filename in fnmatch.filter(files, "*" + REFSSUFFIX):
+                fh = open(os.path.join(base, filename), 'r')
+                try:
+                    for line in fh:
+                        referenced.add(line.strip())
+                finally:
+                    fh.close()
+
+        count = size = 0
+        for base, dirs, files in os.walk(self.storeroot):
+            for filename in files:
+                if filename.endswith(".gpg") and filename[:-4] in referenced:
+                    continue
+                fullfilename = os.path.join(base, filename)
+                size += os.path.getsize(fullfilename)
+                os.unlink(fullfilename)
+                count += 1
+                if self.known is not None:
+                    self.known.discard(filename[:-4])
+
+        return (count, size)
+
+
+def findArchivedFiles (destbase, jobpattern, matches, jobs):
+    """
+    Find encrypted files and recipes under a date folder.  Returns an array
+    of archive file / relative original name pairs, filtered by:
+     matches - List of fnmatch patterns for the relative name (Any may match)
+     jobs - List of fnmatch patterns for the job name, which is the first
+       group of jobpattern matched against the file name
+    Empty filter lists match everything
+    """
+    archived = []
+    for base, dirs, files in os.walk(destbase):
+        if CHUNKSTORE in dirs:
+            dirs.remove(CHUNKSTORE)
+        for filename in files:
+            if filename.endswith(RECIPESUFFIX):
+                origname = filename[:-len(RECIPESUFFIX)]
+            elif filename.endswith(".gpg"):
+                origname = filename[:-4]
+            else:
+                continue
+
+            relname = os.path.relpath(os.path.join(base, origname), destbase)
+            if matches and not [m for m in matches if fnmatch.fnmatch(relname, m)]:
+                continue
+
+            if jobs:
+                jobname = origname
+                if jobpattern:
+                    m = re.search(jobpattern, origname)
+                    if m:
+                        jobname = m.group(1)
+                if not [j for j in jobs if fnmatch.fnmatch(jobname, j)]:
+                    continue
+
+            archived.append([os.path.join(base, filename), relname])
+
+    return archived
+
+
+def restoreFile (gpg, chunkstore, archivefile, outputfile, passphrase=None):
+    """
+    Decrypt a single encrypted file or rebuild a deduplicated recipe into
+    outputfile.  Returns the restored size
+    """
+    if archivefile.endswith(RECIPESUFFIX):
+        return chunkstore.rebuild(archivefile, outputfile, passphrase)
+
+    tempfile = outputfile + ".tmp"
+    fh = open(archivefile, 'rb')
+    try:
+        result = gpg.decrypt_file(fh, passphrase=passphrase, output=tempfile)
+    finally:
+        fh.close()
+    if not result.ok:
+        removeFile(tempfile)
+        raise GeneralError("Could not decrypt %s: %s" % (archivefile, result.status))
+
+    os.rename(tempfile, outputfile)
+    return os.path.getsize(outputfile)
+
+
+def removeFile (path):
+    """
+    Remove a file, ignoring it if it is already gone
+    """
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def restoreArchive (archived, target, gpg, chunkstore, manifest, workers, logger, passphrase=None):
+    """
+    Restore archive file / relative name pairs under target using a pool of
+    worker threads.  Each worker runs one GnuPG decrypt at a time, straight
+    to disk, so memory use is bounded by the worker count.  Completed files
+    are added to a checkpoint in target so an interrupted restore skips them
+    when run again.  If the manifest has an entry for a file, its size and
+    SHA-256 are checked after restore.  Returns the number of files restored,
+    the bytes restored, and the number of failures
+    """
+    checkpointfile = os.path.join(target, RESTORECHECKPOINT)
+
+    # Load the checkpoint from a previous attempt
+    done = set()
+    try:
+        fh = open(checkpointfile, 'r')
+        for line in fh:
+            done.add(line.rstrip("\n"))
+        fh.close()
+    except IOError:
+        pass
+
+    work = Queue.Queue()
+    for (archivefile, relname) in archived:
+        if relname in done and os.path.exists(os.path.join(target, relname)):
+            logger.debug("Already restored %s - Skipping" % relname)
+            continue
+        work.put((archivefile, relname))
+
+    lock = threading.Lock()
+    checkpoint = open(checkpointfile, 'a')
+    totals = {'count': 0, 'size': 0, 'failed': 0}
+
+    def worker():
+        while True:
+            try:
+                (archivefile, relname) = work.get_nowait()
+            except Queue.Empty:
+                return
+
+            outputfile = os.path.join(target, relname)
+            try:
+                makeDirTree(os.path.dirname(outputfile))
+                size = restoreFile(gpg, chunkstore, archivefile, outputfile, passphrase)
+
+                if relname in manifest:
+                    if (manifest[relname][0], manifest[relname][1]) != fileHash(outputfile):
+                        os.unlink(outputfile)
+                        raise GeneralError("Size or SHA-256 does not match manifest")
+            except Exception as detail:
+                logger.warning("Problem restoring %s: \"%s\" - Skipping" % (archivefile, detail))
+                lock.acquire()
+                totals['failed'] += 1
+                lock.release()
+                continue
+
+            lock.acquire()
+            try:
+                checkpoint.write(relname + "\n")
+                checkpoint.flush()
+                totals['count'] += 1
+                totals['size'] += size
+            finally:
+                lock.release()
+            logger.info("Restored %s" % outputfile)
+
+    threads = []
+    for i in range(workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # Join with a timeout so signals still reach the main thread
+    try:
+        for t in threads:
+            while t.isAlive():
+                t.join(1)
+    finally:
+        checkpoint.close()
+
+    # Nothing left to resume after a clean run
+    if not totals['failed']:
+        os.unlink(checkpointfile)
+
+    return (totals['count'], totals['size'], totals['failed'])
+
+
+def findDateFolders (destroot, dateformat):
+    """
+    Return the date folders directly under destroot as an array of time /
+    folder name pairs, oldest first.  Folders whose name does not parse with
+    dateformat are not date folders and are left out
+    """
+    folders = []
+    for name in os.listdir(destroot):
+        if not os.path.isdir(os.path.join(destroot, name)):
+            continue
+        try:
+            stamp = time.strptime(name, dateformat)
+        except ValueError:
+            continue
+        folders.append((stamp, name))
+
+    folders.sort()
+    return folders
+
+
+def folderSize (path):
+    """
+    Return the total size of all files under path
+    """
+    size = 0
+    for base, dirs, files in os.walk(path):
+        for filename in files:
+            size += os.path.getsize(os.path.join(base, filename))
+    return size
+
+
+def readSizeIndex (destroot):
+    """
+    Read the date folder size index under destroot, returning a dictionary
+    of folder name to bytes.  Returns an empty dictionary if there is none
+    """
+    try:
+        fh = open(os.path.join(destroot, SIZEINDEX), 'r')
+    except IOError:
+        return {}
+    try:
+        return json.load(fh)
+    except ValueError:
+        # Damaged index - It is rebuilt as folders are sized again
+        return {}
+    finally:
+        fh.close()
+
+
+def writeSizeIndex (destroot, index):
+    """
+    Save the date folder size index under destroot
+    """
+    writeFileAtomic(os.path.join(destroot, SIZEINDEX), json.dumps(index, sort_keys=True))
+
+
+def readRatioIndex (destroot):
+    """
+    Read the index of encrypted to source size ratios seen in earlier runs
+    under destroot, returning a dictionary of key (See ratioKey) to ratio.
+    Returns an empty dictionary if there is none
+    """
+    try:
+        fh = open(os.path.join(destroot, RATIOINDEX), 'r')
+    except IOError:
+        return {}
+    try:
+        return json.load(fh)
+    except ValueError:
+        # Damaged index - Files are sampled again until it is rebuilt
+        return {}
+    finally:
+        fh.close()
+
+
+def writeRatioIndex (destroot, index):
+    """
+    Save the size ratio index under destroot
+    """
+    writeFileAtomic(os.path.join(destroot, RATIOINDEX), json.dumps(index, sort_keys=True))
+
+
+def findExpiredFolders (destroot, dateformat, current, retaincount, retainbytes, reqspace):
+    """
+    Apply the retention policy to the date folders under destroot.  Returns
+    an array of folder name / size pairs to remove (oldest first) and the
+    updated size index.  The current folder is always kept, but only counts
+    toward retaincount once a run has written to it, and empty folders left
+    by failed runs are not counted or removed, so runs that store nothing
+    never cost an older archive.  If retainbytes is set, old folders are
+    also removed until the kept folders plus reqspace fit within it.  Folder
+    sizes come from the size index, so only folders missing from it are
+    walked
+    """
+    index = readSizeIndex(destroot)
+    folders = [name for (stamp, name) in findDateFolders(destroot, dateformat)]
+
+    # Drop index entries for folders removed by hand and size new ones
+    for name in index.keys():
+        if name not in folders:
+            del index[name]
+    for name in folders:
+        if name not in index:
+            index[name] = folderSize(os.path.join(destroot, name))
+
+    older = [name for name in folders if name != current and index[name]]
+
+    expired = []
+    keep = retaincount
+    if index.get(current):
+        keep -= 1
+    if retaincount and len(older) > keep:
+        expired = older[:len(older) - keep]
+        older = older[len(expired):]
+
+    if retainbytes:
+        total = reqspace + sum([index[name] for name in older])
+        if current in index:
+            total += index[current]
+        while older and total > retainbytes:
+            total -= index[older[0]]
+            expired.append(older.pop(0))
+
+    return ([(name, index[name]) for name in expired], index)
+
+
+def pruneDateFolders (destroot, expired, index):
+    """
+    Remove expired date folders and their size index entries
+    """
+    for (name, size) in expired:
+        shutil.rmtree(os.path.join(destroot, name))
+        del index[name]
+        writeSizeIndex(destroot, index)
 
 
 class EmailReportHandler(logging.Handler):
@@ -459,9 +1507,10 @@ class CapacityError(Error):
     Exception due to low disk space/calculated space
     """
 
-    def __init__(self, overage, msg):
+    def __init__(self, overage, msg, destroot=""):
         self.overage = abs(overage)
         self.msg = msg
+        self.destroot = destroot
 
     def __str__(self):
         """
@@ -498,54 +1547,91 @@ class GeneralError(Error):
         return self.msg
 
 
+def parseArguments (args=None):
+    """
+    Parse command line arguments (sys.argv by default) and return the
+    optparse options.  Exits with a usage message on bad arguments
+    """
+
+    # Parse arguments - XXX - Move this to argparse soon
+    #  Great example of merged ConfigParser/argparse:
+    #  http://blog.vwelch.com/2011/04/combining-configparser-and-argparse.html
+    progname = os.path.basename(__file__)
+    parser = optparse.OptionParser(usage="%s [-c FILE] [--only NAME] [--prune-preview | --gc | --restore SOURCE --target PATH [--match GLOB] [--job GLOB]]" % progname, version="%s %s" % (progname, VERSION))
+    parser.add_option("-c", "--config", dest="conffile", help="use configuration from FILE", metavar="FILE")
+    parser.add_option("--only", dest="only", action="append", default=[], help="only use the job in section [job NAME] (repeatable)", metavar="NAME")
+    parser.add_option("--prune-preview", dest="prunepreview", action="store_true", default=False, help="show the date folders the retention policy would remove, without removing them")
+    parser.add_option("--gc", dest="gc", action="store_true", default=False, help="remove deduplicated chunks no longer used by any recipe")
+    parser.add_option("--restore", dest="restore", help="restore from SOURCE, a date folder (path or name under destroot) or a single archived file", metavar="SOURCE")
+    parser.add_option("--target", dest="target", help="restore into folder PATH, or file PATH for a single archived file", metavar="PATH")
+    parser.add_option("--match", dest="matches", action="append", default=[], help="only restore files with a relative path matching GLOB (repeatable)", metavar="GLOB")
+    parser.add_option("--job", dest="jobs", action="append", default=[], help="only restore files with a job name (see sourcejobnameregex) matching GLOB (repeatable)", metavar="GLOB")
+    parser.add_option("--workers", dest="workers", type="int", default=DEFRESTOREWORKERS, help="number of files to decrypt at once (default %d)" % DEFRESTOREWORKERS, metavar="N")
+    parser.add_option("--passphrase-file", dest="passphrasefile", help="read the secret key passphrase for restores from FILE", metavar="FILE")
+    (options, args) = parser.parse_args(args)
+
+    if options.restore and not options.target:
+        parser.error("--restore requires --target")
+    if options.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    return options
+
+
 class Configure(ConfigParser.ConfigParser):
     """
     Read and maintain configuration settings - Customized for this program.
     All supported options must be filtered/copied in by this class
     """
 
-    def __init__(self):
+    def __init__(self, conffile=None, values=None):
         """
-        Read in configuration from command line and config file(s).  Stores
-        a cleaned dictionary called "settings" that should be usable without
-        further processing
+        Read in configuration from conffile (DEFCONFFILE if not given), or
+        from values, a dictionary of section names to dictionaries of option
+        values, as if read from a file.  Stores a cleaned dictionary called
+        "settings" that should be usable without further processing
         """
         ConfigParser.ConfigParser.__init__(self)
 
         settings = {}
 
-        # Parse arguments - XXX - Move this to argparse soon
-        #  Great example of merged ConfigParser/argparse:
-        #  http://blog.vwelch.com/2011/04/combining-configparser-and-argparse.html
-        progname = os.path.basename(__file__)
-        parser = optparse.OptionParser(usage="%s [-c FILE]" % progname, version="%s %s" % (progname, VERSION))
-        parser.add_option("-c", "--config", dest="conffile", help="use configuration from FILE", metavar="FILE")
-        (options, args) = parser.parse_args()
-        
-        if options.conffile is None:
-            # No config passed, so try the default
-            conffile = DEFCONFFILE
+        if values is not None:
+            conffile = "supplied values"
+            for section in values:
+                self.add_section(section)
+                for (option, value) in values[section].items():
+                    self.set(section, option, str(value))
+
         else:
-            conffile = options.conffile
+            if conffile is None:
+                # No config passed, so try the default
+                conffile = DEFCONFFILE
 
-        if not os.path.isfile(conffile):
-            # This is just a quick check that the config file exists
-            parser.error("Configuration file %s not found" % conffile)
-    
-        try:
-            # Read in configuration file
-            self.read(conffile)
-        except ValueError:
-            raise GeneralError("Bad value in config file - Check your %(variable)s replacements!")
+            if not os.path.isfile(conffile):
+                # This is just a quick check that the config file exists
+                raise GeneralError("Configuration file %s not found" % conffile)
+
+            try:
+                # Read in configuration file
+                self.read(conffile)
+            except ValueError:
+                raise GeneralError("Bad value in config file - Check your %(variable)s replacements!")
 
         if not self.has_section('encrarch'):
             raise GeneralError("You MUST have a [encrarch] section! None found in %s\n" % conffile)
 
-        # The current config file setup only cares about the [encrarch] settings
-        # at this time.  It will be stored in the settings hash
-
-        # Check for required settings under the [encrarch] section
-        req = ['encryptto', 'sourcebase', 'sourcematch', 'destroot', 'pidfile'] 
+        # Global settings come from the [encrarch] section.  Each archive job
+        # comes from a [job NAME] section, with any job options missing there
+        # taken from [encrarch].  With no job sections, [encrarch] is the job.
+        # All of it is stored in the settings hash
+
+        # Check for required global settings under the [encrarch] section -
+        # Supplied values are for library use (See Archiver), which does not
+        # use a pidfile
+        req = ['pidfile'] 
+        if values is not None:
+            req = []
+            settings['pidfile'] = self.jobget('encrarch', 'pidfile')
         errs = ""
         for item in req:
             if not self.has_option('encrarch', item):
@@ -557,22 +1643,14 @@ class Configure(ConfigParser.ConfigParser):
             # Spit out all missing parameters at once
             raise GeneralError(errs)
 
-        # Check if the sourcehobnameregex is defined.  This will allow
-        # skipping older files if there are multiple files with the same
-        # job name in a folder.
-        if self.has_option('encrarch', 'sourcejobnameregex'):
-            settings['sourcejobnameregex'] = self.get('encrarch', 'sourcejobnameregex')
-        else:
-            settings['sourcejobnameregex'] = False
+        # Limits shared by all jobs - Files encrypted at once and total read
+        # bandwidth in bytes per second (0 for unlimited)
+        settings['maxworkers'] = self.intcheck('encrarch', 'maxworkers', 1, 1)
+        settings['maxbandwidth'] = self.intcheck('encrarch', 'maxbandwidth', 0, 0)
 
-        # Check if the sourcedirregex is defined.  This allows matching only
-        # specific folders.
-        if self.has_option('encrarch', 'sourcedirregex'):
-            settings['sourcedirregex'] = self.get('encrarch', 'sourcedirregex')
-        else:
-            settings['sourcedirregex'] = False
+        # Memory allowed for all sources staged in memory at once
+        settings['rambudget'] = self.intcheck('encrarch', 'rambudget', DEFRAMBUDGET, 1)
 
-            
         # If SMTP reporting is enabled, check for those required values
         if self.has_option('encrarch', 'emailon'):
             settings['emailon'] = self.get('encrarch', 'emailon').lower()
@@ -598,7 +1676,7 @@ class Configure(ConfigParser.ConfigParser):
 
 
         # Process optionals to allow for less error prone handling going forward
-        settings['instancename'] = self.get('encrarch', 'instancename', 'encrarch')
+        settings['instancename'] = self.jobget('encrarch', 'instancename', DEFINSTANCENAME)
 
         # Allow override for gpg binary and default home for GnuPG
         if self.has_option('encrarch', 'gpgbinary'):
@@ -622,17 +1700,6 @@ class Configure(ConfigParser.ConfigParser):
         else:
             settings['gpghome'] = getGpgHome()
 
-        if self.has_option('encrarch', 'temppreserve'):
-            settings['temppreserve'] = self.boolcheck(self.get('encrarch', 'temppreserve'))
-
-        else:
-            settings['temppreserve'] = False
-        
-        # Do not save a temp copy by default
-        settings['tempbase'] = self.get('encrarch', 'tempbase', '')
-
-        settings['destdateformat'] = self.get('encrarch', 'destdateformat', '%Y-%m')
-        
         # Set logging level
         if self.has_option('encrarch', 'loglevel'):
             settings['loglevel'] = self.get('encrarch', 'loglevel').upper()
@@ -663,6 +1730,23 @@ class Configure(ConfigParser.ConfigParser):
         else:
             settings['logfile'] = False
             
+        # Build the job list
+        jobsections = [section for section in self.sections() if section.startswith('job ')]
+        if jobsections:
+            settings['jobs'] = [self.jobsettings(section, settings) for section in jobsections]
+        else:
+            settings['jobs'] = [self.jobsettings('encrarch', settings)]
+
+        # Date folders hold the files of every job writing to the destroot,
+        # so the jobs sharing one must agree on how long to keep them
+        policies = {}
+        for jobsets in settings['jobs']:
+            policy = (jobsets['retaincount'], jobsets['retainbytes'])
+            if jobsets['retaincount'] or jobsets['retainbytes']:
+                policy += (jobsets['destdateformat'],)
+            if policies.setdefault(os.path.normpath(jobsets['destroot']), policy) != policy:
+                raise GeneralError("Jobs sharing destroot %s must use the same retaincount, retainbytes, and destdateformat (for [job %s])" % (jobsets['destroot'], jobsets['jobname']))
+
         # Save screened settings back to config 
         self.settings = settings
 
@@ -672,6 +1756,127 @@ class Configure(ConfigParser.ConfigParser):
         """
         return self.settings
 
+    def jobsettings(self, section, globalsettings):
+        """
+        Return the settings dictionary for the job in section - A copy of the
+        global settings with the job's own options added
+        """
+        if section == 'encrarch':
+            name = globalsettings['instancename']
+            folder = ''
+        else:
+            name = section[4:].strip()
+            if not re.match(r'^[A-Za-z0-9\-]+$', name):
+                raise GeneralError("Invalid job section [%s] - Job names may only use letters, numbers, and hyphens" % section)
+            # Jobs may share a destroot, so each writes to its own folder
+            # inside the date folders
+            folder = name
+
+        settings = dict(globalsettings)
+        settings['jobname'] = name
+        settings['jobfolder'] = folder
+
+        # Check for required settings for the job
+        req = ['encryptto', 'sourcebase', 'sourcematch', 'destroot'] 
+        errs = ""
+        for item in req:
+            value = self.jobget(section, item)
+            if value is None:
+                errs += "\n* You must set '%s' in your configuration file" % item
+                if section != 'encrarch':
+                    errs += " (for [%s])" % section
+            else:
+                settings[item] = value
+
+        if errs:
+            # Spit out all missing parameters at once
+            raise GeneralError(errs)
+
+        # Check if the sourcehobnameregex is defined.  This will allow
+        # skipping older files if there are multiple files with the same
+        # job name in a folder.
+        settings['sourcejobnameregex'] = self.jobget(section, 'sourcejobnameregex', False)
+
+        # Check if the sourcedirregex is defined.  This allows matching only
+        # specific folders.
+        settings['sourcedirregex'] = self.jobget(section, 'sourcedirregex', False)
+
+        # Do not save a temp copy by default
+        settings['tempbase'] = self.jobget(section, 'tempbase', '')
+        settings['temppreserve'] = self.boolcheck(self.jobget(section, 'temppreserve', 'false'))
+
+        # Stage files up to this size in memory instead - Off (0) by default
+        settings['ramstagesize'] = self.intcheck(section, 'ramstagesize', 0, 0)
+
+        settings['destdateformat'] = self.jobget(section, 'destdateformat', '%Y-%m')
+
+        # Deduplicated archive format - Off by default
+        settings['dedup'] = self.boolcheck(self.jobget(section, 'dedup', 'false'))
+        settings['dedupchunksize'] = self.intcheck(section, 'dedupchunksize', DEFCHUNKSIZE, 65536)
+        settings['dedupkey'] = self.jobget(section, 'dedupkey', '')
+        if settings['dedup'] and not settings['dedupkey']:
+            raise GeneralError("You must set 'dedupkey' when 'dedup' is true (for [%s])" % section)
+
+        # Retention of date folders under destroot - Off (0) by default
+        settings['retaincount'] = self.intcheck(section, 'retaincount', 0, 0)
+        settings['retainbytes'] = self.intcheck(section, 'retainbytes', 0, 0)
+
+        # Deduplicated date folders only hold recipes, while the data is in
+        # the shared chunk store, so a byte limit on folders means nothing
+        if settings['dedup'] and settings['retainbytes']:
+            raise GeneralError("'retainbytes' is not supported with 'dedup' - Use 'retaincount' instead (for [%s])" % section)
+
+        # Keep a manifest of plain text hashes and sizes - Off by default
+        settings['manifest'] = self.boolcheck(self.jobget(section, 'manifest', 'false'))
+
+        # S3 compatible destination settings, used if destroot is s3://
+        settings['s3endpoint'] = self.jobget(section, 's3endpoint', '')
+        settings['s3secure'] = self.boolcheck(self.jobget(section, 's3secure', 'true'))
+        settings['s3accesskey'] = self.jobget(section, 's3accesskey')
+        settings['s3secretkey'] = self.jobget(section, 's3secretkey')
+        settings['s3partsize'] = self.intcheck(section, 's3partsize', DEFS3PARTSIZE, MINS3PARTSIZE)
+        settings['s3partbuffer'] = self.intcheck(section, 's3partbuffer', DEFS3PARTBUFFER, 1)
+        settings['s3uploadthreads'] = self.intcheck(section, 's3uploadthreads', DEFS3UPLOADTHREADS, 1)
+        settings['s3quota'] = self.intcheck(section, 's3quota', 0, 0)
+
+        if settings['destroot'].startswith('s3://'):
+            if boto is None:
+                raise GeneralError("The boto module is required for S3 destinations (destroot %s)" % settings['destroot'])
+            for item in ['dedup', 'manifest', 'retaincount', 'retainbytes']:
+                if settings[item]:
+                    raise GeneralError("'%s' is not supported with S3 destinations (destroot %s)" % (item, settings['destroot']))
+
+        return settings
+
+    def jobget(self, section, option, default=None):
+        """
+        Return an option from section, falling back to the [encrarch] section,
+        or default if neither sets it
+        """
+        if self.has_option(section, option):
+            return self.get(section, option)
+        elif self.has_option('encrarch', option):
+            return self.get('encrarch', option)
+        return default
+
+    def intcheck(self, section, option, default, minimum):
+        """
+        Return an integer option from section (or [encrarch]), or default if
+        it is not set.  Raises ConfigParser.Error if the value is not a whole
+        number of at least minimum
+        """
+        value = self.jobget(section, option)
+        if value is None:
+            return default
+
+        try:
+            value = int(value)
+        except ValueError:
+            raise ConfigParser.Error("Invalid '%s' value - Must be a whole number" % option)
+        if value < minimum:
+            raise ConfigParser.Error("Invalid '%s' value - Must be at least %d" % (option, minimum))
+        return value
+
     def boolcheck(self, value):
         """
         A more user-friendly True/False checker - Returns True on affirmative
@@ -691,10 +1896,915 @@ class Configure(ConfigParser.ConfigParser):
             return False
 
 
+def applyRetention (sets, reqspace, logger, preview=False):
+    """
+    Remove the date folders the retention policy no longer keeps, making
+    room for reqspace more bytes.  If preview is set, only log what would be
+    removed.  Unused chunks are cleared from the chunk store, if there is
+    one under destroot, after removing folders
+    """
+    current = time.strftime(sets['destdateformat'])
+    (expired, index) = findExpiredFolders(sets['destroot'], sets['destdateformat'], current, sets['retaincount'], sets['retainbytes'], reqspace)
+
+    if preview:
+        for (name, size) in expired:
+            logger.info("Retention preview: Would remove date folder %s (%sB)" % (os.path.join(sets['destroot'], name), humanSize(size)))
+        return
+
+    # Save sizes found for any folders new to the index
+    writeSizeIndex(sets['destroot'], index)
+    if not expired:
+        return
+
+    for (name, size) in expired:
+        logger.info("Retention: Removing date folder %s (%sB)" % (os.path.join(sets['destroot'], name), humanSize(size)))
+    pruneDateFolders(sets['destroot'], expired, index)
+
+    # Other jobs sharing the destroot may use a chunk store even if this
+    # one does not
+    if os.path.isdir(os.path.join(sets['destroot'], CHUNKSTORE)):
+        chunkstore = ChunkStore(os.path.join(sets['destroot'], CHUNKSTORE), None, sets['encryptto'], sets['dedupchunksize'], sets['dedupkey'])
+        (count, size) = chunkstore.collectGarbage(sets['destroot'])
+        logger.info("Retention: Removed %d unused chunks (%sB)" % (count, humanSize(size)))
+
+
+class S3Destination(object):
+    """
+    S3 compatible object storage destination - Each file is encrypted by
+    GnuPG into a named pipe and streamed to the bucket as a multipart upload,
+    so no encrypted copy is kept locally.  Parts are read into a bounded
+    buffer and sent by a pool of upload threads.  As with the local .gpg.tmp
+    files, nothing appears under the final key until the upload completes
+    """
+
+    def __init__(self, sets):
+        """
+         sets - Job settings, with destroot set to s3://BUCKET/PREFIX
+        """
+        m = re.match(r'^s3://([^/]+)/?(.*)$', sets['destroot'])
+        if not m:
+            raise GeneralError("Invalid S3 destroot %s - Must be s3://BUCKET/PREFIX" % sets['destroot'])
+        self.bucketname = m.group(1)
+        self.prefix = m.group(2).strip('/')
+        self.sets = sets
+
+        # Connections are not shared between threads
+        self.local = threading.local()
+
+    def bucket(self):
+        """
+        Return the bucket, using one connection per thread
+        """
+        if not hasattr(self.local, 'bucket'):
+            args = {'aws_access_key_id': self.sets['s3accesskey'], 'aws_secret_access_key': self.sets['s3secretkey'], 'is_secure': self.sets['s3secure']}
+            if self.sets['s3endpoint']:
+                # Local and third party endpoints need path style requests
+                (host, sep, port) = self.sets['s3endpoint'].partition(':')
+                args['host'] = host
+                if port:
+                    args['port'] = int(port)
+                args['calling_format'] = boto.s3.connection.OrdinaryCallingFormat()
+            conn = boto.s3.connection.S3Connection(**args)
+            self.local.bucket = conn.get_bucket(self.bucketname)
+        return self.local.bucket
+
+    def keyName(self, *parts):
+        """
+        Join parts into a key name under the destination prefix
+        """
+        parts = [part.strip('/') for part in (self.prefix,) + parts]
+        return "/".join([part for part in parts if part])
+
+    def freeSpace(self):
+        """
+        Return the space left under s3quota, or sys.maxint if no quota is set
+        """
+        if not self.sets['s3quota']:
+            return sys.maxint
+
+        used = 0
+        for key in self.bucket().list(prefix=self.keyName() and self.keyName() + "/"):
+            used += key.size
+        return self.sets['s3quota'] - used
+
+    def abortStale(self, destprefix):
+        """
+        Cancel multipart uploads left under destprefix (the date folder, plus
+        the job folder if any) by an interrupted run, so their stored parts
+        are released.  Returns the number cancelled
+        """
+        prefix = self.keyName(destprefix) + "/"
+        count = 0
+        for mp in self.bucket().list_multipart_uploads():
+            if mp.key_name.startswith(prefix):
+                mp.cancel_upload()
+                count += 1
+        return count
+
+    def encryptFile(self, gpg, filename, basepath, tempbase, sourcebase, destprefix, recipient, logger, throttle=None, staged=None, outcome=None):
+        """
+        Encrypt one source file for recipient and upload it under destprefix
+        (See abortStale), mirroring basepath.  Files already uploaded with the
+        same source size and modify time are skipped, so an interrupted run
+        picks up where it stopped.  staged and outcome are as for encryptFile
+        - outcome gets "reason" set for files already uploaded, too.  Returns
+        the number of source bytes read, or None if the file was skipped due
+        to a problem
+        """
+        keyname = self.keyName(destprefix, basepath, filename + ".gpg")
+        sfile = os.path.normpath(os.sep.join((tempbase,basepath,filename)))
+
+        # Temp copies get a new modify time, so check the original source
+        try:
+            st = os.stat(os.path.normpath(os.sep.join((sourcebase,basepath,filename))))
+            if staged is not None:
+                sfileh = staged
+            else:
+                sfileh = open(sfile,'rb', -1)
+        except (IOError, OSError):
+            logger.warning("Could not open source %s for reading: Skipping" % sfile)
+            if outcome is not None:
+                outcome['reason'] = "Could not open source %s for reading" % sfile
+            return None
+        metadata = {'encrarch-size': str(st.st_size), 'encrarch-mtime': str(int(st.st_mtime))}
+
+        # Everything from here on runs guarded, so the source is always closed
+        # and the pipe folder removed, whichever step fails
+        fifodir = None
+        mp = None
+        try:
+            existing = self.bucket().get_key(keyname)
+            if existing is not None and existing.get_metadata('encrarch-size') == metadata['encrarch-size'] and existing.get_metadata('encrarch-mtime') == metadata['encrarch-mtime']:
+                logger.info("Already uploaded %s - Skipping" % keyname)
+                if outcome is not None:
+                    outcome['reason'] = "Already uploaded as %s" % keyname
+                return 0
+
+            if throttle:
+                sfileh = ThrottledReader(sfileh, throttle)
+            sfileh = HashingReader(sfileh, False)
+
+            fifodir = tempfile.mkdtemp(prefix="encrarch")
+            fifo = os.path.join(fifodir, "gpg")
+            os.mkfifo(fifo, 0600)
+
+            mp = self.bucket().initiate_multipart_upload(keyname, metadata=metadata)
+            self.streamUpload(gpg, sfileh, recipient, fifo, mp)
+        except Exception as detail:
+            logger.warning("Problem while uploading %s to %s: \"%s\" - Skipping" % (sfile, keyname, detail))
+            if outcome is not None:
+                outcome['reason'] = "Problem while uploading to %s: %s" % (keyname, detail)
+            if mp is not None:
+                mp.cancel_upload()
+            return None
+        finally:
+            sfileh.close()
+            if fifodir:
+                shutil.rmtree(fifodir, True)
+
+        logger.info("Completed uploading file s3://%s/%s" % (self.bucketname, keyname))
+        return sfileh.size
+
+    def streamUpload(self, gpg, sfileh, recipient, fifo, mp):
+        """
+        Run GnuPG writing into fifo while reading it in s3partsize parts and
+        uploading them to multipart upload mp.  At most s3partbuffer parts wait
+        in memory, plus one being sent by each upload thread.  Completes the
+        upload, or raises an exception if encryption or any part failed
+        """
+        parts = Queue.Queue(self.sets['s3partbuffer'])
+        errors = []
+        opened = threading.Event()
+        crypt = {}
+
+        def encrypter():
+            try:
+                crypt['result'] = gpg.encrypt_file(sfileh, recipient, output=fifo, armor=False)
+            finally:
+                # If GnuPG failed before opening the pipe, the reader is still
+                # waiting for a writer - Open and close it to give an end of file
+                unblockReader()
+
+        def unblockReader():
+            while not opened.isSet():
+                try:
+                    os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                    break
+                except OSError as exc:
+                    if exc.errno != errno.ENXIO:
+                        raise
+                    time.sleep(0.1)
+
+        def uploader():
+            # Each thread needs its own connection to the upload
+            upload = boto.s3.multipart.MultiPartUpload(self.bucket())
+            upload.key_name = mp.key_name
+            upload.id = mp.id
+            while True:
+                part = parts.get()
+                if part is None:
+                    return
+                # Keep draining after an error so the reader is not blocked
+                if errors:
+                    continue
+                try:
+                    upload.upload_part_from_file(cStringIO.StringIO(part[1]), part[0])
+                except Exception as detail:
+                    errors.append(detail)
+
+        crypter = threading.Thread(target=encrypter)
+        crypter.daemon = True
+        crypter.start()
+
+        uploaders = []
+        for i in range(self.sets['s3uploadthreads']):
+            t = threading.Thread(target=uploader)
+            t.daemon = True
+            t.start()
+            uploaders.append(t)
+
+        try:
+            fh = open(fifo, 'rb')
+            opened.set()
+            try:
+                partnum = 0
+                while True:
+                    data = fh.read(self.sets['s3partsize'])
+                    if not data:
+                        break
+                    partnum += 1
+                    parts.put((partnum, data))
+
+                # Every upload needs at least one part, even if empty, but no
+                # output at all usually means GnuPG failed - Only send the
+                # empty part once it is known to have succeeded
+                if not partnum:
+                    while crypter.isAlive():
+                        crypter.join(1)
+                    if 'result' in crypt and crypt['result'].ok:
+                        parts.put((1, ''))
+            finally:
+                fh.close()
+        finally:
+            for t in uploaders:
+                parts.put(None)
+            for t in uploaders + [crypter]:
+                while t.isAlive():
+                    t.join(1)
+
+        if 'result' not in crypt or not crypt['result'].ok:
+            raise GeneralError("GnuPG failed: %s" % getattr(crypt.get('result'), 'status', 'no result'))
+        if errors:
+            raise errors[0]
+
+        mp.complete_upload()
+
+
+class ArchiveJob(object):
+    """
+    One archive job - A source, match rules, recipient, and destination - and
+    its progress through a run
+    """
+
+    def __init__(self, sets, logger):
+        """
+         sets - Settings dictionary for the job (See Configure.jobsettings)
+         logger - logging class instance for messages about this job
+        """
+        self.sets = sets
+        self.name = sets['jobname']
+        self.logger = logger
+        self.datename = time.strftime(sets['destdateformat'])
+        self.destbase = os.path.join(sets['destroot'], self.datename)
+        self.destprefix = self.datename
+        if sets['jobfolder']:
+            self.destbase = os.path.join(self.destbase, sets['jobfolder'])
+            self.destprefix += "/" + sets['jobfolder']
+        self.workingsourcebase = sets['sourcebase']
+        self.sources = []
+        self.tempsources = []
+        self.ramsources = set()
+        self.chunkstore = None
+        self.manifest = None
+        self.estimates = {}
+        self.reqspace = 0
+        self.device = None
+
+        # Object storage destination, if destroot is an s3:// URL
+        self.s3 = None
+        if sets['destroot'].startswith('s3://'):
+            self.s3 = S3Destination(sets)
+
+        # Totals for the run
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.estimated = 0
+        self.stored = 0
+        self.ratios = {}
+        self.starttime = time.time()
+        self.endtime = None
+
+    def prepare(self, gpg, reserved, chunkstores, throttle):
+        """
+        Find the source files, apply retention, check destination space, and
+        make temp copies if set.  reserved is a dictionary of bytes already
+        claimed by other jobs on each destination device, and is updated
+        with this job's required space.  chunkstores is a dictionary of
+        ChunkStore instances, shared by jobs with the same destroot and key
+        """
+        sets = self.sets
+
+        # Find our source files
+        self.sources = findSourceFiles(sets['sourcematch'], sets['sourcejobnameregex'], sets['sourcebase'], sets['sourcedirregex'])
+
+        if not (len(self.sources)):
+            self.logger.warn("No suitable files matching %s found in %s" % (sets['sourcematch'], sets['sourcebase']))
+            raise GeneralError("No Files To Backup")
+
+        # Make sure the GPG key exists before wasting a bunch of cycles
+        recuser = lookupKeyFingerprint(gpg, sets['encryptto'])
+
+        # Estimate the encrypted size of each file - Ratios from earlier runs
+        # are only kept for local destinations
+        history = {}
+        if not self.s3:
+            history = readRatioIndex(sets['destroot'])
+        (self.estimates, known) = estimateSources(sets, self.sources, history)
+        self.logger.info("Estimated %sB encrypted for %sB of source files (%d of %d from earlier runs)" % (humanSize(sum([est for (size, est) in self.estimates.values()])), humanSize(sum([size for (size, est) in self.estimates.values()])), known, len(self.sources)))
+
+        if self.s3:
+            # Clear out uploads left by an interrupted run, then check the
+            # space left under the quota
+            if self.s3.abortStale(self.destprefix):
+                self.logger.info("Cancelled incomplete uploads left under %s" % self.destbase)
+            self.reqspace = sum([est for (size, est) in self.estimates.values()])
+            calcroom = self.s3.freeSpace() - self.reqspace
+            self.device = sets['destroot']
+
+        else:
+            # Attempt to build our base path if it does not exist
+            makeDirTree(sets['destroot'])
+
+            # Files replacing copies from an earlier run only need the
+            # difference, plus room for the copies being written
+            (self.reqspace, inflight) = spaceNeeded(self.destbase, self.estimates, sets['dedup'], sets['maxworkers'])
+
+            # Remove old date folders per the retention policy before
+            # checking for space
+            if sets['retaincount'] or sets['retainbytes']:
+                applyRetention(sets, self.reqspace, self.logger)
+
+            # Check for required space on final destination drive
+            calcroom = getFreeSpace(sets['destroot']) - self.reqspace - inflight
+            self.device = os.stat(sets['destroot']).st_dev
+
+        # Less the space other jobs in this run need on the same drive
+        calcroom -= reserved.get(self.device, 0)
+
+        if calcroom < 0:
+            self.logger.error("Insufficient space under %s to hold estimated archive size of %sB! Free %sB to allow archive" % (sets['destroot'], humanSize(self.reqspace), humanSize(abs(calcroom))))
+            raise CapacityError(calcroom, "Low Pre-Archive Destination Space", sets['destroot'])
+
+        reserved[self.device] = reserved.get(self.device, 0) + self.reqspace
+
+        # Files small enough to stage in memory are read in by the workers
+        # as they start on them - The rest use the temp location, if set
+        if sets['ramstagesize']:
+            limit = min(sets['ramstagesize'], sets['rambudget'])
+            for ((filename, relpath), (size, est)) in self.estimates.items():
+                if size <= limit:
+                    self.ramsources.add((filename, relpath))
+            self.logger.info("Staging %d of %d files in memory" % (len(self.ramsources), len(self.sources)))
+
+        # If using a temp location, copy our other sources to it
+        # (Jobs may share a tempbase too, so each copies to its own folder)
+        if sets['tempbase']:
+            tempbase = sets['tempbase']
+            if sets['jobfolder']:
+                tempbase = os.path.join(tempbase, sets['jobfolder'])
+            self.logger.info("Copying from %s to temporary location %s" % (sets['sourcebase'], tempbase))
+            self.tempsources = [(filename, relpath) for (filename, relpath) in self.sources if (filename, relpath) not in self.ramsources]
+            copySourceToTempSource(self.tempsources, sets['sourcebase'], tempbase, throttle)
+            self.workingsourcebase = tempbase
+
+        # Deduplicated archives share one chunk store under destroot.  Jobs
+        # with a different chunk size or key get their own ChunkStore, though
+        # the chunk files still land in the same folder
+        if sets['dedup']:
+            storekey = (os.path.join(sets['destroot'], CHUNKSTORE), sets['encryptto'], sets['dedupkey'], sets['dedupchunksize'])
+            if storekey not in chunkstores:
+                chunkstores[storekey] = ChunkStore(storekey[0], gpg, sets['encryptto'], sets['dedupchunksize'], sets['dedupkey'])
+            self.chunkstore = chunkstores[storekey]
+
+        if sets['manifest']:
+            self.manifest = {}
+
+        self.logger.info("Encrypting files for %s" % recuser)
+
+    def finish(self):
+        """
+        Save the manifest and folder size, log the job totals, and check
+        that the next run will still fit
+        """
+        sets = self.sets
+        self.endtime = time.time()
+
+        if self.manifest:
+            updateManifest(self.destbase, self.manifest)
+
+        # Report how close the size estimates were, and keep the ratios seen
+        # to estimate the next run
+        if self.estimated:
+            self.logger.info("Estimated %sB encrypted for the files written, actual %sB (%+.1f%%)" % (humanSize(self.estimated), humanSize(self.stored), (self.stored - self.estimated) * 100.0 / self.estimated))
+        if self.ratios and not self.s3:
+            history = readRatioIndex(sets['destroot'])
+            history.update(self.ratios)
+            writeRatioIndex(sets['destroot'], history)
+
+        # Record the new size of this date folder for retention checks.  Now
+        # that it holds this run's files, it counts toward the policy, so
+        # apply it again
+        if sets['retaincount'] or sets['retainbytes']:
+            index = readSizeIndex(sets['destroot'])
+            index[self.datename] = folderSize(os.path.join(sets['destroot'], self.datename))
+            writeSizeIndex(sets['destroot'], index)
+            if self.files:
+                applyRetention(sets, 0, self.logger)
+
+        self.logger.debug("Completed archiving of %sB after %s" % (humanSize(self.bytes), datetime.timedelta(seconds=int(self.endtime - self.starttime))))
+
+        # Recheck free space - We need to notify the user if the NEXT archive run is
+        # likely to fail so they have time to switch out destinations.
+        nextspace = sum([est for (size, est) in self.estimates.values()])
+        if self.s3:
+            calcroom = self.s3.freeSpace() - nextspace
+        else:
+            calcroom = getFreeSpace(sets['destroot']) - nextspace
+
+        if calcroom < 0:
+            self.logger.error("Preemptive notice: Next archive may fail!  Low space on %s - Please free %sB before next archive" % (sets['destroot'], humanSize(abs(calcroom))))
+            raise CapacityError(calcroom, "Low Post-Archive Destination Space", sets['destroot'])
+
+    def record(self, filename, relpath, result):
+        """
+        Add the FileResult for a source file to the job totals.  Files with a
+        known encrypted size count toward the estimate report, and their
+        ratio is kept for the next run
+        """
+        if result.status != "archived":
+            self.skipped += 1
+            return
+
+        self.files += 1
+        self.bytes += result.bytes
+        if result.stored is not None and result.bytes:
+            self.estimated += result.estimate
+            self.stored += result.stored
+            self.ratios[ratioKey(self.sets, filename, relpath)] = float(result.stored) / result.bytes
+
+    def storedSize(self, filename, relpath, outcome):
+        """
+        Return the encrypted bytes written for an archived source file, from
+        the outcome dictionary filled in by encryptFile, or None if it is not
+        known.  For deduplicated files, only the new chunks count, so the
+        ratio kept for the next run reflects how much of the file changes
+        between date folders (Reruns into the same folder are not measured)
+        """
+        if self.s3:
+            key = self.s3.bucket().get_key(self.s3.keyName(self.destprefix, relpath, filename + ".gpg"))
+            if key is None:
+                return None
+            return key.size
+        return outcome.get('written')
+
+    def destPath(self, filename, relpath):
+        """
+        Return the path of the encrypted copy of a source file, for local
+        destinations without dedup
+        """
+        return os.path.join(os.path.normpath(os.sep.join((self.destbase, relpath))), filename + ".gpg")
+
+    def cleanup(self):
+        """
+        Clear our temp files if being used and not set to preserve them
+        """
+        if self.tempsources and not self.sets['temppreserve']:
+            clearTempSource(self.tempsources, self.workingsourcebase)
+            self.tempsources = []
+
+    def summary(self):
+        """
+        Return a one line report of the job's totals
+        """
+        elapsed = datetime.timedelta(seconds=int((self.endtime or time.time()) - self.starttime))
+        text = "Job %s: Encrypted %d of %d files (%sB) from %s to %s in %s" % (self.name, self.files, len(self.sources), humanSize(self.bytes), self.sets['sourcebase'], self.destbase, elapsed)
+        if self.estimated:
+            text += " - %sB stored, %sB estimated" % (humanSize(self.stored), humanSize(self.estimated))
+        if self.skipped:
+            text += " - %d skipped" % self.skipped
+        return text
+
+
+class FileResult(object):
+    """
+    The outcome of archiving one source file, as yielded by Archiver.run
+    """
+
+    def __init__(self, job, path, status, size, started, finished, estimate=0, stored=None, reason=None):
+        """
+         job - Name of the job the file belongs to
+         path - Full path of the original source file
+         status - "archived", or "skipped" if a problem kept it out of the
+           archive
+         size - Number of source bytes read
+         started, finished - Times work on the file began and ended
+         estimate - Estimated encrypted size in bytes
+         stored - Actual encrypted size in bytes, or None if not known
+         reason - Why the file was skipped, or why nothing was written for an
+           archived file (already uploaded), else None
+        """
+        self.job = job
+        self.path = path
+        self.status = status
+        self.bytes = size
+        self.started = started
+        self.finished = finished
+        self.elapsed = finished - started
+        self.estimate = estimate
+        self.stored = stored
+        self.reason = reason
+
+    def __repr__(self):
+        if self.reason:
+            return "<FileResult %s %s %s %dB %.2fs: %s>" % (self.job, self.status, self.path, self.bytes, self.elapsed, self.reason)
+        return "<FileResult %s %s %s %dB %.2fs>" % (self.job, self.status, self.path, self.bytes, self.elapsed)
+
+
+def selectJobs (jobs, only):
+    """
+    Return the job settings from jobs with a name in only, or all of them if
+    only is empty.  Raises GeneralError if a name matches no job
+    """
+    if not only:
+        return jobs
+
+    names = [jobsets['jobname'] for jobsets in jobs]
+    for name in only:
+        if name not in names:
+            raise GeneralError("No job named %s - Configured jobs are: %s" % (name, ", ".join(names)))
+    return [jobsets for jobsets in jobs if jobsets['jobname'] in only]
+
+
+class Archiver(object):
+    """
+    Run the archive jobs of a settings dictionary - The same work main() does,
+    for use from other Python programs.  One GnuPG instance and bandwidth
+    limit are kept for every run, so a long running process can call run()
+    as often as needed without setting up again.  For example:
+
+     archiver = Archiver(Configure("/etc/encrarch.conf").get_settings())
+     for result in archiver.run():
+         print result.path, result.status, result.bytes, result.elapsed
+     print archiver.report[1]
+    """
+
+    def __init__(self, sets, logger=None):
+        """
+         sets - Settings dictionary (See Configure.get_settings)
+         logger - Optional logging class instance - The logger named for the
+           instance is used if not given
+        """
+        self.sets = sets
+        if logger is None:
+            logger = logging.getLogger(sets['instancename'])
+        self.logger = logger
+
+        self.gpg = gnupg.GPG(gpgbinary=sets['gpgbinary'], gnupghome=sets['gpghome'])
+
+        self.throttle = None
+        if sets['maxbandwidth']:
+            self.throttle = Throttle(sets['maxbandwidth'])
+
+        self.membudget = MemoryBudget(sets['rambudget'])
+
+        # Jobs, failed jobs, and (subject, summary) of the latest run
+        self.jobs = []
+        self.failed = []
+        self.report = None
+
+        # Destination device, .gpg.tmp path (None if deduplicated), and
+        # estimated size of the files being written, by job name, filename,
+        # and relative path, so workers do not start more files than the
+        # drive can hold
+        self.inflight = {}
+        self.spacelock = threading.Lock()
+
+    def run(self, only=None):
+        """
+        Archive every job (or those with a name in only), yielding a FileResult
+        for each source file as it completes.  Once all files are done, the
+        jobs are finished and self.report is set to a subject and summary.
+        With one job, its problems are raised as GeneralError or
+        CapacityError.  With several, a job that can not run is logged and
+        the others carry on, then a GeneralError lists the failed jobs.
+        Stopping early (closing the generator) waits for files in progress
+        and clears temp copies, without finishing the jobs
+        """
+        jobs = []
+        for jobsets in selectJobs(self.sets['jobs'], only):
+            # The [encrarch] job logs as the instance itself
+            if jobsets['jobname'] == self.sets['instancename']:
+                joblogger = self.logger
+            else:
+                joblogger = logging.getLogger("%s.%s" % (self.logger.name, jobsets['jobname']))
+            jobs.append(ArchiveJob(jobsets, joblogger))
+
+        self.jobs = jobs
+        self.failed = []
+        self.report = None
+
+        # With one job, problems are passed up as before
+        single = (len(jobs) == 1)
+        reserved = {}
+        chunkstores = {}
+        ready = []
+        results = Queue.Queue()
+        stop = threading.Event()
+        threads = []
+
+        try:
+            for job in jobs:
+                try:
+                    job.prepare(self.gpg, reserved, chunkstores, self.throttle)
+                    ready.append(job)
+                except (GeneralError, CapacityError, EnvironmentError) as detail:
+                    if single:
+                        raise
+                    job.logger.error("Job %s not run: %s" % (job.name, detail))
+                    self.failed.append(job)
+
+            threads = self.startWorkers(ready, results, stop)
+
+            # Pass results on as they arrive, waiting with a timeout so
+            # signals still reach the main thread
+            while [t for t in threads if t.isAlive()] or not results.empty():
+                try:
+                    (job, filename, relpath, result) = results.get(True, 1)
+                except Queue.Empty:
+                    continue
+
+                job.record(filename, relpath, result)
+                yield result
+
+            for job in ready:
+                try:
+                    job.finish()
+                except CapacityError as detail:
+                    if single:
+                        raise
+                    self.failed.append(job)
+                except EnvironmentError as detail:
+                    if single:
+                        raise
+                    job.logger.error("Job %s not finished: %s" % (job.name, detail))
+                    self.failed.append(job)
+
+        finally:
+            # Let files in progress complete before clearing temp copies
+            stop.set()
+            for t in threads:
+                while t.isAlive():
+                    t.join(1)
+            for job in jobs:
+                job.cleanup()
+
+        if single:
+            self.report = ("Encryption and Archival Complete", "Job completed normally. Encrypted/archived from %s to %s" % (jobs[0].sets['sourcebase'], jobs[0].sets['destroot']))
+            return
+
+        for job in jobs:
+            self.logger.info(job.summary())
+
+        if self.failed:
+            raise GeneralError("Problems with %d of %d jobs: %s" % (len(self.failed), len(jobs), ", ".join([job.name for job in self.failed])))
+
+        self.report = ("Encryption and Archival Complete", "All %d jobs completed normally:\r\n%s" % (len(jobs), "\r\n".join([job.summary() for job in jobs])))
+
+    def startWorkers(self, jobs, results, stop):
+        """
+        Start a pool of maxworkers threads, shared by every prepared job, to
+        encrypt the jobs' source files.  Files are queued in turn from each
+        job so one large job does not hold up the rest.  The job, filename,
+        relative path, and FileResult are put on the results queue for each
+        file.  Workers stop taking new files once the stop event is set.
+        Returns the threads
+        """
+        work = Queue.Queue()
+        queues = [[(job, filename, relpath) for (filename, relpath) in job.sources] for job in jobs]
+        while [q for q in queues if q]:
+            for q in queues:
+                if q:
+                    work.put(q.pop(0))
+
+        gpg = self.gpg
+        throttle = self.throttle
+
+        def worker():
+            while not stop.isSet():
+                try:
+                    (job, filename, relpath) = work.get_nowait()
+                except Queue.Empty:
+                    return
+
+                started = time.time()
+                path = os.path.normpath(os.sep.join((job.sets['sourcebase'], relpath, filename)))
+                estimate = job.estimates[(filename, relpath)][1]
+                key = (job.name, filename, relpath)
+                staged = None
+                filethrottle = throttle
+                claimed = 0
+                reserved = False
+                outcome = {}
+                size = None
+                stored = None
+
+                # Everything for the file runs guarded, so a problem is
+                # reported as a skipped file instead of ending the worker
+                try:
+                    # Local files are written as .gpg.tmp (or as new chunks if
+                    # deduplicated), so make sure this one fits alongside those
+                    # in progress
+                    tempname = None
+                    if not (job.s3 or job.chunkstore):
+                        tempname = job.destPath(filename, relpath) + ".tmp"
+                    if not job.s3:
+                        reserved = self.reserveSpace(job, key, tempname, estimate)
+                        if not reserved:
+                            outcome['reason'] = "Not enough space left under %s (estimated %sB)" % (job.sets['destroot'], humanSize(estimate))
+                            job.logger.warning("%s for %s - Skipping" % (outcome['reason'], path))
+
+                    # Snapshot small files into memory, so the source is only
+                    # read briefly - Reads from memory are not throttled
+                    if (filename, relpath) in job.ramsources and 'reason' not in outcome:
+                        try:
+                            claimed = os.stat(path).st_size
+                            self.membudget.claim(claimed)
+                            staged = stageSourceInMemory(path, claimed, throttle)
+                            filethrottle = None
+                        except (IOError, OSError) as detail:
+                            job.logger.warning("Could not stage source %s in memory: \"%s\" - Skipping" % (path, detail))
+                            outcome['reason'] = "Could not stage source in memory: %s" % detail
+
+                    if 'reason' in outcome:
+                        pass
+                    elif job.s3:
+                        size = job.s3.encryptFile(gpg, filename, relpath, job.workingsourcebase, job.sets['sourcebase'], job.destprefix, job.sets['encryptto'], job.logger, filethrottle, staged, outcome)
+                    else:
+                        size = encryptFile(gpg, filename, relpath, job.workingsourcebase, job.destbase, job.sets['encryptto'], job.logger, job.chunkstore, job.manifest, filethrottle, staged, outcome)
+
+                    # Files already uploaded read nothing, so are not measured
+                    if size:
+                        stored = job.storedSize(filename, relpath, outcome)
+                except Exception as detail:
+                    job.logger.error("Unexpected error encrypting %s: %s" % (filename, "; ".join(traceback.format_exc().splitlines())))
+                    outcome['reason'] = "Unexpected error: %s" % detail
+                    size = None
+                finally:
+                    if staged is not None:
+                        staged.close()
+                    if claimed:
+                        self.membudget.release(claimed)
+                    if reserved:
+                        self.releaseSpace(key)
+
+                if size is None:
+                    result = FileResult(job.name, path, "skipped", 0, started, time.time(), estimate, None, outcome.get('reason'))
+                else:
+                    result = FileResult(job.name, path, "archived", size, started, time.time(), estimate, stored, outcome.get('reason'))
+                results.put((job, filename, relpath, result))
+
+        threads = []
+        for i in range(self.sets['maxworkers']):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        return threads
+
+    def reserveSpace(self, job, key, tempname, estimate):
+        """
+        Claim estimate bytes on the job's destination drive for the file with
+        key, unique to each source file in the run.  Free space is checked
+        less what is still to be written by the other files in progress on
+        the same drive - The estimate less the size of its temp file so far,
+        or the whole estimate for deduplicated files (tempname None), whose
+        chunks can not be measured as they are written.  Returns False if
+        there is not enough room
+        """
+        self.spacelock.acquire()
+        try:
+            free = getFreeSpace(job.sets['destroot'])
+            for (device, othername, otherestimate) in self.inflight.values():
+                if device != job.device:
+                    continue
+                written = 0
+                if othername:
+                    try:
+                        written = os.path.getsize(othername)
+                    except OSError:
+                        pass
+                free -= max(0, otherestimate - written)
+
+            if free < estimate:
+                return False
+            self.inflight[key] = (job.device, tempname, estimate)
+            return True
+        finally:
+            self.spacelock.release()
+
+    def releaseSpace(self, key):
+        """
+        Drop the space claimed for the file with key once it is written
+        """
+        self.spacelock.acquire()
+        try:
+            self.inflight.pop(key, None)
+        finally:
+            self.spacelock.release()
+
+
+def runMaintenance (sets, opts, logger, gpg=None):
+    """
+    Run the maintenance action selected on the command line instead of an
+    archive.  gpg is the gnupg.GPG instance to restore with - Only needed
+    for restores.  Returns a subject and summary for reporting
+    """
+    if sets['destroot'].startswith('s3://'):
+        raise GeneralError("Maintenance actions are not supported for S3 destinations (destroot %s)" % sets['destroot'])
+
+    chunkstore = ChunkStore(os.path.join(sets['destroot'], CHUNKSTORE), gpg, sets['encryptto'], sets['dedupchunksize'], sets['dedupkey'])
+
+    if opts.prunepreview:
+        if not (sets['retaincount'] or sets['retainbytes']):
+            raise GeneralError("No retention policy set - Set retaincount or retainbytes")
+        sources = findSourceFiles(sets['sourcematch'], sets['sourcejobnameregex'], sets['sourcebase'], sets['sourcedirregex'])
+        (estimates, known) = estimateSources(sets, sources, readRatioIndex(sets['destroot']))
+        (reqspace, inflight) = spaceNeeded(os.path.join(sets['destroot'], time.strftime(sets['destdateformat'])), estimates, sets['dedup'], sets['maxworkers'])
+        applyRetention(sets, reqspace, logger, preview=True)
+        return ("Retention Preview Complete", "Retention preview complete for %s - Nothing was removed" % sets['destroot'])
+
+    if opts.gc:
+        logger.info("Removing unused chunks from %s" % chunkstore.storeroot)
+        (count, size) = chunkstore.collectGarbage(sets['destroot'])
+        return ("Chunk Cleanup Complete", "Removed %d unused chunks, freeing %sB" % (count, humanSize(size)))
+
+    # Passphrase is optional - An agent may already hold the secret key
+    passphrase = None
+    if opts.passphrasefile:
+        fh = open(opts.passphrasefile, 'r')
+        passphrase = fh.readline().rstrip("\r\n")
+        fh.close()
+
+    # A single archived file restores straight to the target file
+    if os.path.isfile(opts.restore):
+        logger.info("Restoring %s to %s" % (opts.restore, opts.target))
+        size = restoreFile(gpg, chunkstore, opts.restore, opts.target, passphrase)
+        return ("Restore Complete", "Restored %sB from %s to %s" % (humanSize(size), opts.restore, opts.target))
+
+    # Date folders may be given by name alone
+    source = opts.restore
+    if not os.path.isdir(source):
+        source = os.path.join(sets['destroot'], opts.restore)
+        if not os.path.isdir(source):
+            raise GeneralError("Restore source %s not found" % opts.restore)
+
+    # Jobs from [job NAME] sections keep their files in their own folder
+    if sets['jobfolder'] and os.path.isdir(os.path.join(source, sets['jobfolder'])):
+        source = os.path.join(source, sets['jobfolder'])
+
+    archived = findArchivedFiles(source, sets['sourcejobnameregex'], opts.matches, opts.jobs)
+    if not archived:
+        raise GeneralError("No archived files under %s match the given filters" % source)
+
+    manifest = readManifest(source)
+    if not manifest:
+        logger.info("No manifest in %s - Restored files will not be verified" % source)
+
+    makeDirTree(opts.target)
+    logger.info("Restoring %d files from %s to %s using %d workers" % (len(archived), source, opts.target, opts.workers))
+    (count, size, failed) = restoreArchive(archived, opts.target, gpg, chunkstore, manifest, opts.workers, logger, passphrase)
+
+    if failed:
+        raise GeneralError("%d files could not be restored - Run again to retry them" % failed)
+    return ("Restore Complete", "Restored %d files (%sB) from %s to %s" % (count, humanSize(size), source, opts.target))
+
+
 def main ():
     # Get configuration with our special Config class
+    opts = parseArguments()
     try:
-        conf = Configure()
+        conf = Configure(opts.conffile)
     except Exception, err:
         sys.exit("Problem loading configuration: %s" % err)
 
@@ -704,9 +2814,6 @@ def main ():
     # Pull settings hash for quick access
     sets = conf.get_settings()
 
-    # Build full destination path
-    destbase = os.path.join(sets['destroot'], time.strftime(sets['destdateformat']))
-
     # Setup base logger and formatting
     logger = logging.getLogger(sets['instancename'])
     logger.setLevel(sets['loglevel'])
@@ -720,9 +2827,6 @@ def main ():
     logger.addHandler(clog)
     
 
-    # Handy lambda to pretty print sizes - From Anonymous post to
-    # http://www.5dollarwhitebox.org/drupal/node/84
-    humansize = lambda s:[(s%1024**i and "%.1f"%(s/1024.0**i) or str(s/1024**i))+x.strip() for i,x in enumerate(' KMGTPEZY') if s<1024**(i+1) or i==8][0]
     
     # Wrap main flow so we get output to logs on failure
     try:
@@ -750,61 +2854,39 @@ def main ():
             logger.error("Previous instance already running! Remove pidfile %s if incorrect" % sets['pidfile'])
             raise GeneralError("Already Running")
             
-        # Mark our start time
-        starttime = time.time()
-
-        # Find our source files and copy into temp folders
-        sources = findSourceFiles(sets['sourcematch'], sets['sourcejobnameregex'], sets['sourcebase'], sets['sourcedirregex'])
-        
-        if not (len(sources)):
-            logger.warn("No suitable files matching %s found in %s" % (sets['sourcematch'], sets['sourcebase']))
-            raise GeneralError("No Files To Backup")
-        
-        # Make sure the GPG key exists before wasting a bunch of cycles
-        recuser = lookupKeyFingerprint(sets['gpgbinary'], sets['gpghome'], sets['encryptto'])
-
-        # Attempt to build our base path if it does not exist
-        makeDirTree(sets['destroot'])
-
-        # Check for required space on final destination drive
-        (calcroom, reqspace) = roomForFiles(sets['sourcebase'], sources, sets['destroot'])
-
-        if calcroom < 0:
-            logger.error("Insufficient space under %s to hold total archive size of %sB! Free %sB to allow archive" % (sets['destroot'], humansize(reqspace), humansize(abs(calcroom))))
-            raise CapacityError(calcroom, "Low Pre-Archive Destination Space")
-
-        # If using a temp location, copy our sources to it
-        if sets['tempbase']:
-            logger.info("Copying from %s to temporary location %s" % (sets['sourcebase'], sets['tempbase']))
-            copySourceToTempSource(sources, sets['sourcebase'], sets['tempbase'])
-            workingsourcebase = sets['tempbase']
+        # Limit the run to the jobs named on the command line
+        sets['jobs'] = selectJobs(sets['jobs'], opts.only)
+
+        # Maintenance actions replace the normal archive run
+        if opts.gc or opts.restore or opts.prunepreview:
+            if opts.restore and len(sets['jobs']) > 1:
+                raise GeneralError("Choose the job to restore from with --only")
+
+            # Jobs without a retention policy have nothing to preview
+            if opts.prunepreview:
+                sets['jobs'] = [jobsets for jobsets in sets['jobs'] if jobsets['retaincount'] or jobsets['retainbytes']]
+                if not sets['jobs']:
+                    raise GeneralError("No retention policy set - Set retaincount or retainbytes")
+
+            gpg = None
+            if opts.restore:
+                gpg = gnupg.GPG(gpgbinary=sets['gpgbinary'], gnupghome=sets['gpghome'])
+            results = [runMaintenance(jobsets, opts, logger, gpg) for jobsets in sets['jobs']]
+            subject = results[0][0]
+            summary = "\r\n".join([result[1] for result in results])
 
         else:
-            # We will work with the real source, not a temp source
-            workingsourcebase = sets['sourcebase']
-
-        # Create dest folders and encrypt/compress files, saving into folders
-        logger.info("Encrypting files for %s" % recuser)
-
-        encryptSourcesToDestination(sources, workingsourcebase, destbase, sets['gpgbinary'], sets['gpghome'], sets['encryptto'], logger)
-
-        # Shut it down and report elapsed time
-        endtime = time.time()
-        logger.debug("Completed archiving of %sB after %s" % (humansize(reqspace), datetime.timedelta(seconds=int(endtime - starttime))))
-
-        # Recheck free space - We need to notify the user if the NEXT archive run is
-        # likely to fail so they have time to switch out destinations.
-        (calcroom, reqspace) = roomForFiles(sets['sourcebase'], sources, sets['destroot'])
-
-        if calcroom < 0:
-            logger.error("Preemptive notice: Next archive may fail!  Low space on %s - Please free %sB before next archive" % (sets['destroot'], humansize(abs(calcroom))))
-            raise CapacityError(calcroom, "Low Post-Archive Destination Space")
+            # Files are logged as they complete, so just run through them
+            archiver = Archiver(sets, logger)
+            for result in archiver.run():
+                pass
+            (subject, summary) = archiver.report
 
     #### Exception handler/logging collection - This is for all end of run cleanup
     #### We want to avoid silent death
     except CapacityError as detail:
-        logger.warning("Destination Capacity Insufficient: Please free at least %sB on %s" % (humansize(detail.overage), sets['destroot']))
-        if 'emailon' in sets: elog.send("Destination Capacity Insufficient", "Please free at least %sB on %s" % (humansize(detail.overage), sets['destroot']))
+        logger.warning("Destination Capacity Insufficient: Please free at least %sB on %s" % (humanSize(detail.overage), detail.destroot))
+        if 'emailon' in sets: elog.send("Destination Capacity Insufficient", "Please free at least %sB on %s" % (humanSize(detail.overage), detail.destroot))
         sys.exit(1)
     except GeneralError as detail:
         logger.warning("GeneralError: %s" % detail)
@@ -824,14 +2906,9 @@ def main ():
         if 'emailon' in sets: elog.send("Unhandled Problems Encountered", "Unexpected errors were encountered - Please review and forward to support:\r\n\r\n%s" % traceback.format_exc())
         raise
     else:
-        logger.info("Job completed normally. Encrypted/archived from %s to %s" % (sets['sourcebase'], sets['destroot']))
+        logger.info(summary)
         if (('emailon' in sets) and (sets['emailon'] == "all")):  
-            elog.send("Encryption and Archival Complete", "Job completed normally. Encrypted/archived from %s to %s" % (sets['sourcebase'], sets['destroot']))
- 
-    finally:
-        # Clear our temp files if being used and set to clear temp
-        if sets['temppreserve'] == True and sets['tempbase']:
-            clearTempSource(sources, sets['tempbase'])
+            elog.send(subject, summary)
 
     exit(0)
 